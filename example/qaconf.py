@@ -1,4 +1,6 @@
-from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import sys
 import time
 
 from qa import TemplateVM, DispVM, AppVM, DispVMTemplate
@@ -8,6 +10,7 @@ from qa import QVMPrefs, VM, PCIDevice
 def config():
     SYS_VPN_APPVMS_COLOR = "yellow"
     DEFAULT_NETVM_APPVMS_COLOR = SYS_VPN_APPVMS_COLOR
+    DEFAULT_NETVM = "sys-firewall"
 
     debian_11 = TemplateVM("debian-11", None, None, [])
     # Use add_salt to perform custom salt commands like adding files, installing packages, running commands,
@@ -17,9 +20,9 @@ def config():
     debian_11.add_salt(FileManage("/etc/mpv/mpv.conf", "mpv.conf", user="root", mode="644"))
 
     # Create a template VM for doing finance with.
-    debian_11_bank = debian_11.cloned("debian-11-bank", None, None, [])
+    debian_11_bank = debian_11.cloned("debian-11-bank", [])
     debian_11_bank.add_salt(FileManage("/etc/apt/sources.list", "apt/bullseye-sid-main.list", user="root", mode="644"))
-    debian_11_bank.add_salt(InstallPackage("debian-11-bank", ["banking-app"])
+    debian_11_bank.add_salt(InstallPackage("debian-11-bank", ["banking-app"]))
     bank = AppVM("bank", debian_11_bank, QVMPrefs(DEFAULT_NETVM_APPVMS_COLOR, netvm=DEFAULT_NETVM, start_memory=400, max_memory=1000), ["banking-app.desktop"])
 
     # Other templates
@@ -31,10 +34,10 @@ def config():
 
     # Signal VM
     # debian-11-minimal-signal is cloned from debian-11-minimal and contains all the same packages and files installed like bzip2
-    debian_11_minimal_signal = debian_11_minimal.cloned("debian-11-minimal-signal", None, None, [])
+    debian_11_minimal_signal = debian_11_minimal.cloned("debian-11-minimal-signal", [])
     debian_11_minimal_signal.add_salt(RunCommand("curl -s -x 127.0.0.1:8082 https://updates.signal.org/desktop/apt/keys.asc | apt-key add -"))
     debian_11_minimal_signal.add_salt(FileManage("/etc/apt/sources.list", "apt/bullseye-main-signal", user="root", mode="644"))
-    debian_11_minimal_signal.add_salt(InstallPackage(debian_11_minimal_signal.get_name(), ["signal-desktop"]))
+    debian_11_minimal_signal.add_salt(InstallPackage(debian_11_minimal_signal.name, ["signal-desktop"]))
 
     signal = AppVM("signal", debian_11_minimal_signal, QVMPrefs(DEFAULT_NETVM_APPVMS_COLOR, netvm=DEFAULT_NETVM, start_memory=400, max_memory=4000, autostart=True), ["signal-desktop.desktop"])
 
@@ -49,24 +52,34 @@ def config():
 
 
 def main():
-    start_time = time.time()
+    # qa logs per-item progress at INFO; raise the level (e.g. WARNING) to
+    # skip the formatting work entirely on large configs
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    start = time.perf_counter()
     vms = config()
 
     # Create Signal VMs
-    vms["debian-11-minimal-signal"].apply()
-    vms["signal"].apply()
+    # Templates apply before the AppVMs that depend on them; independent VMs
+    # within one level apply in parallel
+    for level in VM.levelize([vms["debian-11-minimal-signal"], vms["signal"]]):
+        with ThreadPoolExecutor(max_workers=min(8, len(level))) as ex:
+            list(ex.map(lambda vm: vm.apply(), level))
 
     # sys_usb template got corrupted or compromised: destroy and recreate VM
-    vms["sys-usb-template"].regenerate()
+    vms["sys-usb-template"].regenerate(vms)
 
     # Check all VMs configurations and update all updateable TemplateVMs
-    for i, (name, vm) in enumerate(vms.items()):
-    print(i, name)
-    vm.check()
-    if type(vm) == TemplateVM and vm.is_updateable():
-        vm.upgrade()
-    print()
-
-    print("Time taken: ", int(time.time() - start_time))
+    # Each check()/upgrade() blocks on qvm-*/salt subprocesses for independent
+    # VMs, so overlap them with a thread pool instead of paying the latencies
+    # end-to-end
+    results = VM.check_all()
+    templates = [vm for vm in vms.values() if vm._needs_upgrade and vm.is_updateable()]
+    with ThreadPoolExecutor(max_workers=min(8, len(vms))) as ex:
+        list(ex.map(lambda vm: vm.upgrade(), templates))
+    # One buffered write instead of a stdout lock + flush per VM
+    sys.stdout.write("".join(f"{i} {name} needs_update={results[name]}\n"
+            for i, name in enumerate(vms)))
+
+    print(f"Time taken: {(time.perf_counter() - start) * 1000:.1f} ms")
 
 
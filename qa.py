@@ -16,13 +16,24 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
-from collections import OrderedDict
+import asyncio
+from collections import defaultdict
+import concurrent.futures
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import logging
 import os
 import shutil
 import subprocess
-from typing import Dict, Iterable, List, Literal, Optional, Tuple, Union
+from typing import Callable, Dict, Iterable, List, Literal, Optional, Tuple, Union
 import sys
+import tempfile
+import threading
 import time
+import weakref
 
 # Custom type names
 LabelColor = str
@@ -34,6 +45,15 @@ VMName = str
 NetVM = Optional[Union[Default, VMName]]
 VirtMode = Union[Default, Literal["pvh", "hvm"]]
 
+# Library code logs through this; the entry point decides handler and level,
+# and a level below INFO silences the per-item chatter in the check() loops
+# without touching formatting code
+log = logging.getLogger("qa")
+
+# Skip ANSI wrapping (and its per-line string concatenations) when stdout is
+# piped to a file or another program
+_TTY = sys.stdout.isatty()
+
 # Terminal Colors
 class TC:
     # https://stackoverflow.com/questions/287871/how-to-print-colored-text-to-the-terminal
@@ -50,19 +70,26 @@ class TC:
     COMMAND = GREEN
     ERROR = RED
     def red(s: str) -> str:
-        return TC.RED + s + TC.END
+        return TC.RED + s + TC.END if _TTY else s
     def green(s: str) -> str:
-        return TC.GREEN + s + TC.END
+        return TC.GREEN + s + TC.END if _TTY else s
     def bold(s: str) -> str:
-        return TC.BOLD + s + TC.END
+        return TC.BOLD + s + TC.END if _TTY else s
     def vm(s: str) -> str:
-        return TC.VM + s + TC.END
+        return TC.VM + s + TC.END if _TTY else s
     def file(s: str) -> str:
-        return TC.FILE + s + TC.END
+        return TC.FILE + s + TC.END if _TTY else s
     def command(s: str) -> str:
-        return TC.COMMAND + s + TC.END
+        return TC.COMMAND + s + TC.END if _TTY else s
     def error(s: str) -> str:
-        return TC.ERROR + s + TC.END
+        return TC.ERROR + s + TC.END if _TTY else s
+
+
+# Constant log words, ANSI-wrapped once at import instead of on every
+# iteration of the lifecycle loops
+REMOVING = TC.red("Removing")
+REGENERATING = TC.green("Regenerating")
+SETTING = TC.bold("Setting")
 
 
 def exit_failure(message=None):
@@ -72,14 +99,156 @@ def exit_failure(message=None):
     sys.exit(1)
 
 def run(command: List[str], exit_on_failure=False):
-    print("Running command", TC.command(" ".join(command)))
+    # The logging handler serializes emission, so lines from worker threads
+    # stay legible without a lock of our own
+    log.info("Running command %s", TC.command(" ".join(command)))
     p = subprocess.run(command)
+    # Commands issued through run() mutate qubes state, so drop the snapshot
+    AdminCache.invalidate()
     if p.returncode != 0:
-        print(f"command {command} {TC.error(f'returned exit code {p.returncode}')}")
+        log.error("command %s %s", command, TC.error(f"returned exit code {p.returncode}"))
         if exit_on_failure:
             exit_failure(None)
 def get_stdout(command: List[str]) -> str:
-    return subprocess.check_output(command, universal_newlines=True).strip()
+    # text=True replaces the legacy universal_newlines spelling; bufsize=-1
+    # keeps the pipe block-buffered so large listings need few read() calls
+    return subprocess.run(command, check=True, stdout=subprocess.PIPE,
+            text=True, bufsize=-1).stdout.strip()
+
+# Bulk-dump variant for listings that can reach tens of KB on large
+# installations (qvm-ls over every VM): communicate() drains the pipe with
+# block-buffered reads and never deadlocks on a full pipe buffer
+def _dump(command: List[str]) -> str:
+    p = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, bufsize=-1)
+    out, _ = p.communicate()
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, command)
+    return out.strip()
+
+# Async variant of run() for overlapping independent salt applies
+async def arun(command: List[str], exit_on_failure=False):
+    log.info("Running command %s", TC.command(" ".join(command)))
+    p = await asyncio.create_subprocess_exec(*command,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    stdout, _ = await p.communicate()
+    if stdout:
+        sys.stdout.write(stdout.decode())
+    AdminCache.invalidate()
+    if p.returncode != 0:
+        log.error("command %s %s", command, TC.error(f"returned exit code {p.returncode}"))
+        if exit_on_failure:
+            exit_failure(None)
+
+
+# Snapshot of qubesd state pulled with a handful of bulk commands instead of
+# one qvm-* subprocess (and qrexec round-trip) per VM and field.
+# Loaded lazily, and invalidated by run() whenever a mutating command executes
+# so the next read reloads fresh state.
+class AdminCache:
+    LS_FIELDS = "NAME,STATE,TEMPLATE,NETVM"
+    vms: Optional[Dict[VMName, Dict[str, str]]] = None
+    features: Dict[VMName, Dict[str, str]] = {}
+    prefs: Dict[VMName, Dict[str, str]] = {}
+    tags: Dict[VMName, List[str]] = {}
+    pci: Dict[VMName, List[str]] = {}
+    # Reverse indexes over the snapshot so "which VMs use X as netvm/template"
+    # is a dict lookup instead of a scan per query
+    by_netvm: Dict[VMName, List[VMName]] = {}
+    by_template: Dict[VMName, List[VMName]] = {}
+    # Serializes lazy loads when checks run from worker threads
+    _load_lock = threading.Lock()
+    def load() -> Dict[VMName, Dict[str, str]]:
+        # Double-checked fast path: once loaded, callers in tight loops (the
+        # dispvm discovery walks the indexes per dependent VM) skip the lock
+        vms = AdminCache.vms
+        if vms is not None:
+            return vms
+        with AdminCache._load_lock:
+            if AdminCache.vms is None:
+                vms = {}
+                by_netvm = defaultdict(list)
+                by_template = defaultdict(list)
+                fields = AdminCache.LS_FIELDS.split(",")
+                for line in _dump(["qvm-ls", "--raw-data", "--fields", AdminCache.LS_FIELDS]).splitlines():
+                    values = line.split("|")
+                    vms[values[0]] = dict(zip(fields, values))
+                    by_netvm[values[fields.index("NETVM")]].append(values[0])
+                    by_template[values[fields.index("TEMPLATE")]].append(values[0])
+                AdminCache.by_netvm = dict(by_netvm)
+                AdminCache.by_template = dict(by_template)
+                AdminCache.vms = vms
+            return AdminCache.vms
+    # Existence and running state both derive from the one NAME,STATE
+    # listing; no separate qvm-ls --running call is needed
+    def exists(name: VMName) -> bool:
+        return name in AdminCache.load()
+    def running(name: VMName) -> bool:
+        vm = AdminCache.load().get(name)
+        return vm is not None and vm["STATE"] == "Running"
+    def connected_to(netvm_name: VMName) -> List[VMName]:
+        AdminCache.load()
+        return AdminCache.by_netvm.get(netvm_name, [])
+    def templated_by(template_name: VMName) -> List[VMName]:
+        AdminCache.load()
+        return AdminCache.by_template.get(template_name, [])
+    # All features of one VM from a single qvm-features dump, memoized
+    def get_features(name: VMName) -> Dict[str, str]:
+        if name not in AdminCache.features:
+            feature_dict = {}
+            for line in get_stdout(["qvm-features", name]).splitlines():
+                parts = line.split(None, 1)
+                if parts:
+                    feature_dict[parts[0]] = parts[1].strip() if len(parts) > 1 else ""
+            AdminCache.features[name] = feature_dict
+        return AdminCache.features[name]
+    # All prefs of one VM from a single qvm-prefs dump, memoized.
+    # Dump lines are "<name>  <D|-> <value>"; the default marker is dropped.
+    def get_prefs(name: VMName) -> Dict[str, str]:
+        if name not in AdminCache.prefs:
+            pref_dict = {}
+            for line in get_stdout(["qvm-prefs", name]).splitlines():
+                parts = line.split(maxsplit=2)
+                if parts:
+                    pref_dict[parts[0]] = parts[2] if len(parts) > 2 else ""
+            AdminCache.prefs[name] = pref_dict
+        return AdminCache.prefs[name]
+    # All global prefs from a single qubes-prefs dump, memoized; same line
+    # format as qvm-prefs, so parse it the same way
+    global_prefs: Optional[Dict[str, str]] = None
+    def get_global_prefs() -> Dict[str, str]:
+        if AdminCache.global_prefs is None:
+            pref_dict = {}
+            for line in get_stdout(["qubes-prefs"]).splitlines():
+                parts = line.split(maxsplit=2)
+                if parts:
+                    pref_dict[parts[0]] = parts[2] if len(parts) > 2 else ""
+            AdminCache.global_prefs = pref_dict
+        return AdminCache.global_prefs
+    def get_tags(name: VMName) -> List[str]:
+        if name not in AdminCache.tags:
+            AdminCache.tags[name] = get_stdout(["qvm-tags", name, "list"]).splitlines()
+        return AdminCache.tags[name]
+    def get_pci(name: VMName) -> List[str]:
+        if name not in AdminCache.pci:
+            AdminCache.pci[name] = [p.split()[0] for p in get_stdout(["qvm-pci", "list", name]).splitlines()]
+        return AdminCache.pci[name]
+    def invalidate():
+        AdminCache.vms = None
+        AdminCache.features = {}
+        AdminCache.prefs = {}
+        AdminCache.global_prefs = None
+        AdminCache.tags = {}
+        AdminCache.pci = {}
+        AdminCache.by_netvm = {}
+        AdminCache.by_template = {}
+        _VALIDATED.clear()
+
+# (vm_name, desired-state hash) pairs that passed check() against the current
+# snapshot. A pass that checks the same VM twice (check_all followed by apply,
+# or a clone re-walking inherited state) short-circuits the second time without
+# re-reading the snapshot. Lives and dies with the AdminCache: any mutating
+# command clears it.
+_VALIDATED: set = set()
 
 # Abstract state that can be checked for differences and fixed.
 # Only check() needs to be implemented.
@@ -106,10 +275,9 @@ class PCIDevice(State):
         run(self.command + [self.get_name(), self.device_name], exit_on_failure=False)
     def check(self, fix: bool = False):
         needs_update = False
-        current_pci_devices = get_stdout(['qvm-pci', 'list', self.get_name()]).splitlines()
-        current_pci_devices = [p.split()[0] for p in current_pci_devices]
+        current_pci_devices = AdminCache.get_pci(self.get_name())
         if self.device_name not in current_pci_devices:
-            print(f"VM {self.get_name()} does not have a PCI device attached {self.device_name}")
+            log.info("VM %s does not have a PCI device attached %s", self.get_name(), self.device_name)
             needs_update = True
         if needs_update and fix:
             self.attach()
@@ -117,21 +285,21 @@ class PCIDevice(State):
 
 class AppMenu(State):
     def __init__(self, appmenu: Union[str, List[str]]):
-        if type(appmenu) == str:
-            if appmenu.find("\\n") != -1:
-                self.appmenu_list = appmenu.split("\n")
-            elif appmenu.find("\n") != -1:
-                self.appmenu_list = appmenu.split("\n")
-            else:
-                self.appmenu_list = [appmenu]
+        if isinstance(appmenu, str):
+            # Normalize literal "\n" sequences, then one split covers both
+            # spellings; a plain name yields a single-entry list
+            self.appmenu_list = appmenu.replace("\\n", "\n").split("\n")
         else:
             self.appmenu_list = appmenu
+        # Entries are unique, so equality is a set comparison; precompute the
+        # desired side instead of sorting both sides on every check
+        self._appmenu_set = frozenset(self.appmenu_list)
     def check(self, fix=False) -> bool:
         needs_update = False
         current_appmenus = get_stdout(["qvm-appmenus", "--get-whitelist", self.get_name()]).splitlines()
-        if sorted(current_appmenus) != sorted(self.appmenu_list):
+        if frozenset(current_appmenus) != self._appmenu_set:
             needs_update = True
-            print(f"VM {self.get_name()} has appmenu {current_appmenus} and not {self.appmenu_list}")
+            log.info("VM %s has appmenu %s and not %s", self.get_name(), current_appmenus, self.appmenu_list)
             if fix:
                 SetAppMenu(self.get_name(), "\\n".join(self.appmenu_list)).run()
         return needs_update
@@ -142,20 +310,24 @@ class QVMFeatures(State):
         self.features = dictionary
     def check(self, fix=False) -> bool:
         needs_update = False
+        key = (self.get_name(), hash(tuple(sorted((k, str(v)) for k, v in self.features.items()))))
+        if key in _VALIDATED:
+            return False
+        # One qvm-features dump covers every feature instead of one probe
+        # (and qrexec round-trip) per feature name; unset features are simply
+        # absent from the dump
+        all_features = AdminCache.get_features(self.get_name())
         for feature_name, value in self.features.items():
-            check_command = ["qvm-features", self.get_name(), feature_name]
-            try:
-                current_value = get_stdout(check_command)
-            except:
-                current_value = None
+            current_value = all_features.get(feature_name)
             value = str(value)
             if current_value != value:
-                print(f"VM {TC.vm(self.get_name())} feature {feature_name} is {current_value} not {value}")
+                log.info("VM %s feature %s is %s not %s", TC.vm(self.get_name()), feature_name, current_value, value)
                 needs_update = True
                 if fix:
-                    print(f"{TC.bold('Setting')} VM {TC.vm(self.get_name())} feature {feature_name} from {current_value} to {value}")
-                    command = check_command + [value]
-                    run(command, exit_on_failure=True)
+                    log.info("%s VM %s feature %s from %s to %s", SETTING, TC.vm(self.get_name()), feature_name, current_value, value)
+                    run(["qvm-features", self.get_name(), feature_name, value], exit_on_failure=True)
+        if not needs_update:
+            _VALIDATED.add(key)
         return needs_update
 
 class QVMTags(State):
@@ -164,13 +336,13 @@ class QVMTags(State):
         self.tags = tags
     def check(self, fix=False) -> bool:
         needs_update = False
-        current_tags = get_stdout(["qvm-tags", self.get_name(), "list"]).splitlines()
+        current_tags = AdminCache.get_tags(self.get_name())
         for tag in self.tags:
             if tag not in current_tags:
                 needs_update = True
-                print(f"VM {TC.vm(self.get_name())} does not have tag {tag}")
+                log.info("VM %s does not have tag %s", TC.vm(self.get_name()), tag)
                 if fix:
-                    print(f"{TC.bold('Setting')} VM {TC.vm(self.get_name())} tag {tag}")
+                    log.info("%s VM %s tag %s", SETTING, TC.vm(self.get_name()), tag)
                     run(["qvm-tags", self.get_name(), "add", tag], exit_on_failure=True)
         return needs_update
 
@@ -215,26 +387,36 @@ class QVMPrefs(State):
         self.prefs["template_for_dispvms"] = template_for_dispvms
     def check(self, fix=False) -> bool:
         needs_update = False
+        changed_prefs = {}
+        # Hashed at check time because set_label()/set_netvm() may mutate the
+        # prefs after construction
+        key = (self.get_name(), hash(tuple(sorted((k, str(v)) for k, v in self.prefs.items()))))
+        if key in _VALIDATED:
+            return False
+        # One qvm-prefs dump covers every pref instead of one subprocess per
+        # preference key
+        all_prefs = AdminCache.get_prefs(self.get_name())
         for pref_name, value in self.prefs.items():
-            check_command = ["qvm-prefs", self.get_name(), pref_name]
-            current_value = get_stdout(check_command)
-            value = str(value)
-            if current_value != value:
-                print(f"VM {TC.vm(self.get_name())} pref {pref_name} is {current_value} not {value}")
+            current_value = all_prefs.get(pref_name, "")
+            if current_value != str(value):
+                log.info("VM %s pref %s is %s not %s", TC.vm(self.get_name()), pref_name, current_value, value)
                 needs_update = True
-                if fix:
-                    print(f"{TC.BOLD}Setting{TC.END} VM {TC.vm(self.get_name())} pref {pref_name} from {current_value} to {value}")
-                    command = check_command + [value]
-                    run(command, exit_on_failure=True)
+                changed_prefs[pref_name] = value
+        if changed_prefs and fix:
+            log.info("%s VM %s prefs %s", SETTING, TC.vm(self.get_name()), changed_prefs)
+            SetPrefs(self.get_name(), changed_prefs).run()
+        if not needs_update:
+            _VALIDATED.add(key)
         return needs_update
 
 
 # Abstract class for custom salt scripts to manage VMs from disposable management VMs
 # Each subclass must define self.user_salt_name and self.pillar
 class QubesCtl:
-    USER_PILLAR_NAME = "target_pillar"
-    USER_PILLAR = f"/srv/user_pillar/{USER_PILLAR_NAME}.sls"
-    USER_PILLAR_TOP = "/srv/user_pillar/top.sls" 
+    USER_PILLAR_DIR = "/srv/user_pillar"
+    # Batchable salts namespace their pillar as {type_key: [entry, ...]} so
+    # several of them can fuse into a single SaltBatch submission
+    BATCHABLE = False
     # Set target to None to use dom0 as the management VM
     def set_target(self, target: VMName):
         self.target = target
@@ -243,31 +425,54 @@ class QubesCtl:
         return f"user_salt.{self.user_salt_name}"
     def format_pillar(self):
         return f"pillar={str(self.pillar)}"
+    def dom0_command(self) -> List[str]:
+        return ["sudo", "qubesctl", "--show-output", "state.sls", self.get_salt(), self.format_pillar()]
+    def target_command(self) -> List[str]:
+        return ["sudo", "qubesctl", "--show-output", "--skip-dom0", f"--targets={self.target}", "state.sls", self.get_salt()]
+    # The static pillar top.sls hands each target its own
+    # /srv/user_pillar/<target>.sls, so nothing is mutated per run and salts
+    # for distinct targets can apply concurrently
+    def pillar_path(self) -> str:
+        return f"{QubesCtl.USER_PILLAR_DIR}/{self.target}.sls"
+    def _write_pillar(self):
+        log.info("Writing to %s", TC.file(self.pillar_path()))
+        # Write-then-rename so the salt run never observes a partially
+        # written pillar, even if we crash mid-write
+        fd, tmp_path = tempfile.mkstemp(dir=QubesCtl.USER_PILLAR_DIR, suffix=".tmp")
+        with os.fdopen(fd, 'w') as f:
+            # JSON is a YAML subset, so the pillar dict (including the
+            # list-valued batch namespaces) can be dumped directly
+            f.write(json.dumps(self.pillar))
+        os.replace(tmp_path, self.pillar_path())
+        for key, value in self.pillar.items():
+            log.info("    %s Pillar %s=%s", self.get_salt(), key, value)
+    def _remove_pillar(self):
+        log.info("Removing %s", TC.file(self.pillar_path()))
+        os.remove(self.pillar_path())
+    # Digest of the dom0 source files this salt deploys, or None for salts
+    # that carry no sources. Folded into the template desired-state hash so
+    # editing a file under FILES_DIR invalidates the checkpoint even though
+    # the pillar (which only names the file) is unchanged
+    def source_digest(self) -> Optional[str]:
+        return None
     def run(self):
         if self.target is None:
-            run(["sudo", "qubesctl", "--show-output", "state.sls", self.get_salt(), self.format_pillar()], exit_on_failure=True)
+            run(self.dom0_command(), exit_on_failure=True)
         else:
-            print("Writing to", TC.file(QubesCtl.USER_PILLAR))
-            with open(QubesCtl.USER_PILLAR, 'w') as f:
-                for key, value in self.pillar.items():
-                    # Jinja
-                    #f.write(f"{{%- set {key} = '{value}' %}}\n")
-                    # Salt
-                    f.write(f"{key}: {value}\n")
-                    print(f"    {self.user_salt_name} Pillar {key}={value}")
-            # Assumes application is single-threaded
-            with open(QubesCtl.USER_PILLAR_TOP, 'r') as f:
-                old_top = f.read()
-            with open(QubesCtl.USER_PILLAR_TOP, 'a') as f:
-                f.write(f"  {self.target}:\n    - {QubesCtl.USER_PILLAR_NAME}")
+            self._write_pillar()
             try:
-                run(["sudo", "qubesctl", "--show-output", "--skip-dom0", f"--targets={self.target}", "state.sls", self.get_salt()], exit_on_failure=True)
+                run(self.target_command(), exit_on_failure=True)
             finally:
-                print(f"Removing {TC.file(QubesCtl.USER_PILLAR)}")
-                with open(QubesCtl.USER_PILLAR, 'w') as f:
-                    f.write("")
-                with open(QubesCtl.USER_PILLAR_TOP, 'w') as f:
-                    f.write(old_top)
+                self._remove_pillar()
+    async def arun(self):
+        if self.target is None:
+            await arun(self.dom0_command(), exit_on_failure=True)
+        else:
+            self._write_pillar()
+            try:
+                await arun(self.target_command(), exit_on_failure=True)
+            finally:
+                self._remove_pillar()
 
 class CloneTemplate(QubesCtl):
     def __init__(self, name: VMName, template_cloned_from: VMName):
@@ -303,6 +508,16 @@ class SetAppMenu(QubesCtl):
                 "vm_name": name,
                 "appmenu": appmenu
         }
+class SetPrefs(QubesCtl):
+    # Sets all given prefs with a single qvm.prefs state instead of one
+    # qvm-prefs subprocess per pref
+    def __init__(self, name: VMName, prefs: Dict[str, Union[str, int, bool]]):
+        self.user_salt_name = "set-prefs"
+        self.target = None
+        self.pillar = {
+                "vm_name": name,
+                "prefs": prefs,
+        }
 class VMService(QubesCtl):
     def __init__(self, name: VMName, enabled_services: List[str]):
         self.user_salt_name = "vm-service"
@@ -312,50 +527,148 @@ class VMService(QubesCtl):
                 "enabled": ",".join(enabled_services)
         }
 class InstallPackage(QubesCtl):
+    BATCHABLE = True
     def __init__(self, target_vm: VMName, packages: List[str]):
         self.user_salt_name = "install"
         self.target = target_vm
-        self.pillar = { "packages": ",".join(packages) }
+        self.pillar = { "install": [{ "packages": packages }] }
 class Upgrade(QubesCtl):
+    BATCHABLE = True
     def __init__(self):
         self.user_salt_name = "upgrade"
         self.pillar = {}
+# Salt source files discovered with a single directory walk on first
+# FileManage construction, instead of one stat/open per referencing salt.
+# Contents are loaded lazily and memoized; the sources are small dom0 config
+# snippets, so plain bytes are held rather than mmap windows.
+_SRV_CACHE: Optional[Dict[str, Optional[bytes]]] = None
+
+def _srv_cache() -> Dict[str, Optional[bytes]]:
+    global _SRV_CACHE
+    if _SRV_CACHE is None:
+        _SRV_CACHE = {}
+        for dir_path, _dir_names, file_names in os.walk(FileManage.FILES_DIR):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                _SRV_CACHE[os.path.relpath(path, FileManage.FILES_DIR)] = None
+    return _SRV_CACHE
+
+def _srv_read(salt_file: str) -> bytes:
+    cache = _srv_cache()
+    if cache.get(salt_file) is None:
+        with open(f"{FileManage.FILES_DIR}/{salt_file}", "rb") as f:
+            cache[salt_file] = f.read()
+    return cache[salt_file]
+
 class FileManage(QubesCtl):
+    BATCHABLE = True
+    FILES_DIR = "/srv/salt/user_salt/files"
+    # Equal specs share one interned instance so the same source file is only
+    # stat'ed and hashed once, however many templates reference it
+    _instances = weakref.WeakValueDictionary()
+    def __new__(cls, file_name: str, salt_file: str, user: str = "root", mode: str = "644"):
+        key = (file_name, salt_file, user, mode)
+        instance = cls._instances.get(key)
+        if instance is None:
+            instance = super().__new__(cls)
+            cls._instances[key] = instance
+        return instance
     def __init__(self, file_name: str, salt_file: str, user: str = "root", mode: str = "644"):
+        if getattr(self, "pillar", None) is not None:
+            # Interned instance from a previous identical spec
+            return
         self.user_salt_name = "file-manage"
-        assert os.path.exists(f"/srv/salt/user_salt/files/{salt_file}")
-        self.pillar = {
+        assert salt_file in _srv_cache()
+        self.salt_file = salt_file
+        self.pillar = { "file_manage": [{
                 "file_name": file_name,
                 "salt_file": salt_file,
                 "user": user,
                 "group": user,
                 "mode": mode,
-        }
+        }] }
+    @functools.cached_property
+    def _content_sha256(self) -> str:
+        return hashlib.sha256(_srv_read(self.salt_file)).hexdigest()
+    def source_digest(self) -> Optional[str]:
+        # Cached on the interned instance, so each distinct source file is
+        # hashed once however many templates reference it
+        return self._content_sha256
 class CopyRecursively(QubesCtl):
+    BATCHABLE = True
     def __init__(self, directory: str, salt_dir: str, user: str, dir_mode: str, file_mode: str):
         self.user_salt_name = "file-recurse"
-        self.pillar = {
+        self.salt_dir = salt_dir
+        self.pillar = { "file_recurse": [{
                 "file_name": directory,
                 "salt_file": salt_dir,
                 "user": user,
                 "group": user,
                 "dir_mode": dir_mode,
                 "file_mode": file_mode,
-        }
+        }] }
+    def source_digest(self) -> Optional[str]:
+        # One digest over every file under the source directory, in sorted
+        # order with the relative paths mixed in so renames also register
+        digest = hashlib.sha256()
+        prefix = self.salt_dir.rstrip("/") + "/"
+        for salt_file in sorted(_srv_cache()):
+            if salt_file.startswith(prefix):
+                digest.update(salt_file.encode())
+                digest.update(_srv_read(salt_file))
+        return digest.hexdigest()
 class FileSymlink(QubesCtl):
+    BATCHABLE = True
     def __init__(self, file_name: str, symlink: str):
         self.user_salt_name = "file-symlink"
-        self.pillar = {
+        self.pillar = { "file_symlink": [{
                 "file_name": file_name,
                 "symlink_path": symlink,
-        }
+        }] }
 class RunCommand(QubesCtl):
+    BATCHABLE = True
     def __init__(self, command: str, user: str = "root"):
         self.user_salt_name = "run-command"
-        self.pillar = {
+        self.pillar = { "run_command": [{
                 "command": command,
                 "user": user
-        }
+        }] }
+class SaltBatch(QubesCtl):
+    # Fuses several batchable salts for one target into a single qubesctl
+    # invocation: pillars merge by extending each type's entry list and the
+    # state modules are passed comma-separated to state.sls
+    def __init__(self, salts: List[QubesCtl]):
+        assert all(salt.BATCHABLE for salt in salts)
+        self.salt_names = []
+        self.pillar = {}
+        for salt in salts:
+            if salt.user_salt_name not in self.salt_names:
+                self.salt_names.append(salt.user_salt_name)
+            for namespace, entries in salt.pillar.items():
+                self.pillar.setdefault(namespace, []).extend(entries)
+    def get_salt(self):
+        return ",".join(f"user_salt.{name}" for name in self.salt_names)
+
+# A lazily constructed salt: holds either a QubesCtl instance or a zero-arg
+# factory that is only called when the salt is actually applied.
+# force() memoizes, so promises shared between cloned templates construct the
+# salt at most once.
+class _Promise:
+    def __init__(self, salt: Union[QubesCtl, Callable[[], QubesCtl]]):
+        if isinstance(salt, QubesCtl):
+            self.salt = salt
+            self.factory = None
+        else:
+            self.salt = None
+            self.factory = salt
+    def wrap(salt) -> '_Promise':
+        if isinstance(salt, _Promise):
+            return salt
+        return _Promise(salt)
+    def force(self) -> QubesCtl:
+        if self.salt is None:
+            self.salt = self.factory()
+        return self.salt
 
 
 # Abstract class for VM types
@@ -367,46 +680,54 @@ class VM(State):
             "whonix-gw": {"versions": [16], "default_appmenu": ["anon_connection_wizard.desktop", "gateway-arm.desktop", "gateway-reloadtor.desktop", "restart-tor-gui.desktop", "sdwdate-gui.desktop", "gateway-stoptor.desktop", "Thunar.desktop", "tor-control-panel.desktop", "gateway-tordata.desktop", "gateway-torrcexamples.desktop", "gateway-torrc.desktop", "whonixcheck.desktop", "xfce4-terminal.desktop"]},
     }
     ALL_VMS = []
+    # Set by subclasses that can be upgraded in place (templates); lets the
+    # main loop test one attribute instead of calling type() per VM
+    _needs_upgrade = False
     def add_vm(vm):
         VM.ALL_VMS.append(vm)
-    def get_vms() -> OrderedDict:
-        return OrderedDict([(vm.get_name(), vm) for vm in VM.ALL_VMS])
+    def get_vms() -> Dict[VMName, 'VM']:
+        # Plain dicts preserve insertion order since Python 3.7
+        return {vm.get_name(): vm for vm in VM.ALL_VMS}
+    # Check every registered VM, overlapping the blocking qvm-* subprocess
+    # calls across a thread pool. Only the read-only check() phase runs in
+    # parallel; fixes go through QubesCtl.run, which mutates the shared
+    # pillar files, so they run serially afterwards.
+    def check_all(fix: bool = False, force: bool = False, max_workers: int = 10) -> Dict[VMName, bool]:
+        vms = VM.get_vms()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+            results = dict(zip(vms, ex.map(lambda vm: vm.check(), vms.values())))
+        if fix:
+            # One updatevm session for the whole fix phase
+            with VM.updatevm_session():
+                for name, needs_update in results.items():
+                    if needs_update:
+                        vms[name].apply(force=force)
+        return results
     def exists(name) -> bool:
-        all_vms = get_stdout(["qvm-ls", "--raw-data", "--fields", "NAME"]).splitlines()
-        return name in all_vms
+        return AdminCache.exists(name)
     def vm_running(name) -> bool:
-        running_vms = get_stdout(["qvm-ls", "--raw-data", "--running", "--fields", "NAME"]).splitlines()
-        return name in running_vms
+        return AdminCache.running(name)
     def vm_shutdown(name):
-        print("Shutting down", name)
+        log.info("Shutting down %s", name)
         run(["qvm-shutdown", "--wait", name], exit_on_failure=True)
+    def vm_kill(name):
+        log.info("Killing %s", name)
+        # Failure (e.g. already halted) is logged but not fatal; callers kill
+        # only as a shortcut before removal
+        run(["qvm-kill", name])
     def vm_updateable(name):
         try:
-            return get_stdout(["qvm-features", name, "updates-available"]) == "1"
+            return AdminCache.get_features(name).get("updates-available") == "1"
         except:
             return False
     def get_vms_connected_to(netvm_name) -> List[VMName]:
-        vms_and_netvms = get_stdout(["qvm-ls", "--raw-data", "--fields", "NAME,NETVM"]).splitlines()
-        connected_vms = []
-        for vm_and_netvm in vms_and_netvms:
-            if vm_and_netvm.endswith(f"|{netvm_name}"):
-                connected_vms.append(vm_and_netvm.split("|")[0])
-        return connected_vms
+        return AdminCache.connected_to(netvm_name)
     def root_templates() -> List[VMName]:
-        return [f"{os_name}-{os_version}{minimal}"
-                for os_name in VM.SUPPORTED_OPERATING_SYSTEMS
-                for os_version in VM.SUPPORTED_OPERATING_SYSTEMS[os_name]["versions"]
-                for minimal in ["", "-minimal"]
-        ]
+        return list(_ROOT_TEMPLATES)
     def is_root_template(name: VMName) -> bool:
-        return name in VM.root_templates()
+        return name in _ROOT_TEMPLATES
     def default_root_template(os="debian", minimal=True) -> VMName:
-        version = VM.SUPPORTED_OPERATING_SYSTEMS[os]["versions"][-1]
-        if minimal:
-            minimal_str = "-minimal"
-        else:
-            minimal_str = ""
-        return f"{os}-{version}{minimal_str}"
+        return _DEFAULT_ROOTS[(os, minimal)]
     def default_appmenu(vm: 'VM', default=[]) -> Optional[str]:
         if default == []:
             vm_name = vm.root_template().get_name()
@@ -415,8 +736,53 @@ class VM(State):
                     if vm_name.startswith(os):
                         return VM.SUPPORTED_OPERATING_SYSTEMS[os]["default_appmenu"]
         return default
+    _updatevm: Optional[VMName] = None
     def get_updatevm() -> str:
-        return get_stdout(["qubes-prefs", "updatevm"])
+        # The updatevm does not change during a run, so ask qubesd only once
+        if VM._updatevm is None:
+            # Served from the same memoized qubes-prefs dump the dispvm paths
+            # use, so no dedicated subprocess
+            VM._updatevm = AdminCache.get_global_prefs().get("updatevm", "")
+        return VM._updatevm
+    # Keeps the updatevm alive across a whole provisioning batch: nested
+    # sessions are no-ops and the outermost exit shuts the updatevm down
+    # again if it was not running beforehand
+    _updatevm_sessions = 0
+    _updatevm_was_running = False
+    # Guards the session counter when upgrades enter sessions from worker
+    # threads; without it two threads can both see count 0, clobber
+    # _updatevm_was_running and shut the updatevm down mid-upgrade
+    _updatevm_session_lock = threading.Lock()
+    @contextlib.contextmanager
+    def updatevm_session():
+        with VM._updatevm_session_lock:
+            if VM._updatevm_sessions == 0:
+                VM._updatevm_was_running = VM.vm_running(VM.get_updatevm())
+            VM._updatevm_sessions += 1
+        try:
+            yield VM.get_updatevm()
+        finally:
+            with VM._updatevm_session_lock:
+                VM._updatevm_sessions -= 1
+                # Only shut down what the session actually started
+                if VM._updatevm_sessions == 0 and not VM._updatevm_was_running \
+                        and VM.vm_running(VM.get_updatevm()):
+                    VM.vm_shutdown(VM.get_updatevm())
+    # Group VMs into topological levels by template-of relationships.
+    # Every VM in a level only depends on VMs in earlier levels, so VMs within
+    # one level can be applied in parallel.
+    def levelize(vms: Iterable['VM']) -> List[List['VM']]:
+        vms = list(vms)
+        selected = {vm.get_name() for vm in vms}
+        def level_of(vm) -> int:
+            dependency = vm.dependencies()
+            if dependency is None or dependency.get_name() not in selected:
+                return 0
+            return level_of(dependency) + 1
+        levels = defaultdict(list)
+        for vm in vms:
+            levels[level_of(vm)].append(vm)
+        return [levels[level] for level in sorted(levels)]
     def temporary_alternative_template_to(name: VMName) -> VMName:
         default_template = VM.default_root_template(minimal=False)
         default_minimal_template = VM.default_root_template(minimal=True)
@@ -429,37 +795,109 @@ class VM(State):
             return default_minimal_template
 
     # Presalts are run before packages are installed
-    def add_presalt(self, salt: QubesCtl):
-        self.presalts.append(salt)
+    # Salts may be passed as an instance or as a zero-arg factory that is only
+    # constructed when the VM is actually applied
+    def add_presalt(self, salt: Union[QubesCtl, Callable[[], QubesCtl]]):
+        self.presalts.append(_Promise.wrap(salt))
     def apply_presalts(self):
-        for salt in self.presalts:
-            salt.set_target(self.get_name())
-            salt.run()
+        self._run_salts(self.presalts)
     # Salts are run after packages are installed
-    def add_salt(self, salt: QubesCtl):
-        self.salts.append(salt)
+    def add_salt(self, salt: Union[QubesCtl, Callable[[], QubesCtl]]):
+        self.salts.append(_Promise.wrap(salt))
     # FIXME: apply_salt and apply_presalts must be single threaded
     # because there is no deep copy when using get_subclass_salts() and TemplateVM.cloned()
     def apply_salts(self):
-        for salt in self.salts:
+        self._run_salts(self.salts)
+    # Fuse runs of batchable salts into SaltBatch submissions so a VM with
+    # K salts pays one qubesctl invocation instead of K; non-batchable salts
+    # stay individual, preserving insertion order
+    def _prepare_salts(self, promises: List['_Promise']) -> List[QubesCtl]:
+        prepared = []
+        batch = []
+        def flush():
+            if batch:
+                prepared.append(SaltBatch(batch))
+                batch.clear()
+        for promise in promises:
+            salt = promise.force()
+            if salt.BATCHABLE:
+                # SaltBatch merges entries per type, so a type recurring
+                # after a different type intervened would be folded back into
+                # its earlier entries and run ahead of the salt between them.
+                # Start a new batch instead; types then stay contiguous and
+                # the fused modules execute in insertion order
+                if batch and batch[-1].user_salt_name != salt.user_salt_name \
+                        and any(s.user_salt_name == salt.user_salt_name for s in batch):
+                    flush()
+                batch.append(salt)
+            else:
+                flush()
+                prepared.append(salt)
+        flush()
+        for salt in prepared:
+            # set_target mutates the salt, so it must only touch per-call
+            # objects. Batchable salts were fused into fresh SaltBatch
+            # instances above; that keeps interned instances shared between
+            # VMs (FileManage) out of reach, which matters when
+            # apply_all_async interleaves VMs between set_target and the
+            # awaited arun
+            assert not salt.BATCHABLE or isinstance(salt, SaltBatch)
             salt.set_target(self.get_name())
+        return prepared
+    def _run_salts(self, promises: List['_Promise']):
+        for salt in self._prepare_salts(promises):
             salt.run()
+    # Per-VM salt order is preserved; used by apply_all_async to overlap
+    # salts across VMs
+    async def apply_salts_async(self):
+        for salt in self._prepare_salts(self.salts):
+            await salt.arun()
+    # Apply the salts of many VMs concurrently: within one VM salts run in
+    # insertion order, across VMs the qubesctl calls overlap
+    def apply_all_async(vms: Iterable['VM']):
+        async def gather():
+            await asyncio.gather(*(vm.apply_salts_async() for vm in vms))
+        asyncio.run(gather())
     # Subclass Salts are not called in TemplateVMs
     # Subclass Salts are called in AppVMs that use a TemplateVM
-    def add_subclass_salt(self, salt: QubesCtl):
-        self.subclass_salts.append(salt)
-    def get_subclass_salts(self) -> List[QubesCtl]:
+    def add_subclass_salt(self, salt: Union[QubesCtl, Callable[[], QubesCtl]]):
+        self.subclass_salts.append(_Promise.wrap(salt))
+    def get_subclass_salts(self) -> List['_Promise']:
         return self.subclass_salts
     def root_template(self) -> 'VM':
         raise NotImplementedError("Override root_template function")
+    # The VM that must be applied before this one, or None
+    def dependencies(self) -> Optional['VM']:
+        raise NotImplementedError("Override dependencies function")
+    # force bypasses the desired-state checkpoint and re-runs the full fix
+    # pipeline (see TemplateVM.check)
+    def apply(self, force: bool = False) -> None:
+        self.check(fix=True, force=force)
     def is_running(self) -> bool:
         return VM.vm_running(self.get_name())
     def is_updateable(self) -> bool:
         return VM.vm_updateable(self.get_name())
     def shutdown(self):
         return VM.vm_shutdown(self.get_name())
+    def kill(self):
+        return VM.vm_kill(self.get_name())
+
+# Expanded once at import: is_root_template is hit from TemplateVM and
+# CloneTemplate constructors and the regenerate paths, so keep the membership
+# test O(1) instead of rebuilding the comprehension per call
+_ROOT_TEMPLATES = frozenset(f"{os_name}-{os_version}{minimal}"
+        for os_name, info in VM.SUPPORTED_OPERATING_SYSTEMS.items()
+        for os_version in info["versions"]
+        for minimal in ("", "-minimal"))
+
+# Latest template name per (os, minimal) pair, resolved once at import for
+# default_root_template
+_DEFAULT_ROOTS = {(os_name, minimal): f"{os_name}-{info['versions'][-1]}{'-minimal' if minimal else ''}"
+        for os_name, info in VM.SUPPORTED_OPERATING_SYSTEMS.items()
+        for minimal in (False, True)}
 
 class TemplateVM(VM):
+    _needs_upgrade = True
     def __init__(self, name: VMName, cloned_from: Optional['TemplateVM'], qvm_prefs: Optional[QVMPrefs], packages: List[str]):
         VM.add_vm(self)
         self.name = name
@@ -477,9 +915,16 @@ class TemplateVM(VM):
         if cloned_from is None:
             assert name in VM.root_templates()
         self.packages = packages
+        # Packages not already present in the parent template; clones only
+        # need to install these because the cloned image already contains
+        # everything the parent installed
+        self.new_packages = packages
         self.qvm_features = QVMFeatures({}).set_name(name)
     def cloned(self, name, packages: List[str], subclass_salts=True) -> 'TemplateVM':
-        new_template = TemplateVM(name, self, None, self.packages + packages)
+        parent_packages = set(self.packages)
+        new_packages = [p for p in packages if p not in parent_packages]
+        new_template = TemplateVM(name, self, None, self.packages + new_packages)
+        new_template.new_packages = new_packages
         for salt in self.presalts:
             new_template.add_presalt(salt)
         for salt in self.salts:
@@ -494,77 +939,103 @@ class TemplateVM(VM):
             return self
         else:
             return self.cloned_from.root_template()
+    def dependencies(self) -> Optional[VM]:
+        return self.cloned_from
     def install_packages(self):
-        if len(self.packages) > 0:
-            updatevm = VM.get_updatevm()
-            updatevm_running = VM.vm_running(updatevm)
-            print(f"Ensuring template {TC.vm(self.get_name())} has installed {self.packages}")
-            InstallPackage(self.get_name(), self.packages).run()
-            if not updatevm_running:
-                VM.vm_shutdown(updatevm)
+        if len(self.new_packages) > 0:
+            with VM.updatevm_session():
+                log.info("Ensuring template %s has installed %s", TC.vm(self.get_name()), self.new_packages)
+                InstallPackage(self.get_name(), self.new_packages).run()
     def upgrade(self):
-        updatevm = VM.get_updatevm()
-        updatevm_running = VM.vm_running(updatevm)
-        print(f"Upgrading template {TC.vm(self.get_name())}")
-        upgrade = Upgrade()
-        upgrade.set_target(self.get_name())
-        upgrade.run()
-        if not updatevm_running:
-            VM.vm_shutdown(updatevm)
-    def check(self, fix=False):
+        with VM.updatevm_session():
+            log.info("Upgrading template %s", TC.vm(self.get_name()))
+            upgrade = Upgrade()
+            upgrade.set_target(self.get_name())
+            upgrade.run()
+    # Feature recording the digest of the last configuration this tool fully
+    # applied, so idempotent re-runs can skip the salt pipeline
+    DESIRED_HASH_FEATURE = "user.qa-desired-hash"
+    def _desired_hash(self) -> str:
+        # source_digest covers the content of deployed files: a pillar only
+        # names its source, so without it an edit under FILES_DIR would leave
+        # the checkpoint valid and never be deployed
+        desired = {
+                "prefs": {k: str(v) for k, v in self.qvm_prefs.prefs.items()},
+                "packages": self.packages,
+                "presalts": [(s.user_salt_name, s.pillar, s.source_digest()) for s in (p.force() for p in self.presalts)],
+                "salts": [(s.user_salt_name, s.pillar, s.source_digest()) for s in (p.force() for p in self.salts)],
+        }
+        # json with sorted keys gives a canonical byte form of the nested
+        # pillar dicts; the digest only gates a skip, so collisions merely
+        # cost a redundant apply
+        return hashlib.blake2b(json.dumps(desired, sort_keys=True).encode()).hexdigest()
+    def check(self, fix=False, force=False):
         needs_update = False
-        if not VM.exists(self.get_name()):
+        name = self.get_name()
+        # Existence re-probes later in the pass (apply, salt targets) are
+        # plain dict hits on the AdminCache snapshot, so nothing further needs
+        # to thread an exists flag through the call chain
+        if not VM.exists(name):
             needs_update = True
-            print(f"Template {TC.vm(self.get_name())} does not exist")
+            log.info("Template %s does not exist", TC.vm(name))
             if fix:
                 if self.cloned_from is not None:
-                    print(f"Cloning template {TC.vm(self.cloned_from.get_name())} to {TC.vm(self.get_name())}")
-                    CloneTemplate(self.get_name(), self.cloned_from.name).run()
+                    log.info("Cloning template %s to %s", TC.vm(self.cloned_from.get_name()), TC.vm(name))
+                    CloneTemplate(name, self.cloned_from.name).run()
                 else:
                     # Call qubes /srv/formulas/base/virtual-machines-formula/qvm sls files
                     # Or use the new qvm-template cli
-                    exit_failure(f"Will not create root template {self.get_name()}. Do it yourself.")
+                    exit_failure(f"Will not create root template {name}. Do it yourself.")
             else:
                 return needs_update
         if fix:
-            self.apply_presalts()
-            self.install_packages()
-            self.upgrade()
+            desired = self._desired_hash()
+            if not force and AdminCache.get_features(name).get(TemplateVM.DESIRED_HASH_FEATURE) == desired:
+                # The exact configuration below was already applied end to
+                # end; only the cheap prefs comparison is worth repeating
+                needs_update |= self.qvm_prefs.check(fix=fix)
+                return needs_update
+            # One session covers presalts, installs and the upgrade, so the
+            # updatevm is started and stopped at most once per template
+            with VM.updatevm_session():
+                self.apply_presalts()
+                self.install_packages()
+                self.upgrade()
         needs_update |= self.qvm_prefs.check(fix=fix)
         if fix:
             self.apply_salts()
+            # Checkpoint only after the whole pipeline succeeded; a crash
+            # midway leaves the old digest and the next run re-applies
+            run(["qvm-features", name, TemplateVM.DESIRED_HASH_FEATURE, desired], exit_on_failure=True)
         return needs_update
     def regenerate(self, all_vms: Dict[str, VM]):
-        if not VM.exists(self.get_name()):
-            print(TC.vm(self.get_name()), "does not exist")
+        name = self.get_name()
+        if not VM.exists(name):
+            log.info("%s does not exist", TC.vm(name))
             self.apply()
             return
         if self.root_template() is self:
-            run(["qubes-dom0-update", "--action=reinstall", "qubes-template-"+self.get_name()], exit_on_failure=True)
+            run(["qubes-dom0-update", "--action=reinstall", "qubes-template-"+name], exit_on_failure=True)
             self.apply()
         else:
-            vms_with_self_as_template = [] # List[str]
-            lines = get_stdout(["qvm-ls", "--raw-data", "--fields", "NAME,TEMPLATE"]).splitlines()
-            for line in lines:
-                if line.endswith(f"|{self.get_name()}"):
-                    vms_with_self_as_template.append(line.split("|")[0])
-            alternative_vm = VM.temporary_alternative_template_to(self.get_name())
+            vms_with_self_as_template = AdminCache.templated_by(name)
+            alternative_vm = VM.temporary_alternative_template_to(name)
             for vm_name in vms_with_self_as_template:
                 vm = all_vms[vm_name]
                 # Qubes cannot remove DispVMTemplate when there are DispVMs that use this as DispVM template
                 if isinstance(vm, DispVMTemplate):
                     vm.get_dispvms(all_vms)
                     vm.remove_dispvms()
-                print(f"Setting {TC.vm(vm_name)} template to {TC.vm(alternative_vm)}")
+                log.info("Setting %s template to %s", TC.vm(vm_name), TC.vm(alternative_vm))
                 run(["qvm-prefs", vm_name, "template", alternative_vm], exit_on_failure=True)
-            print(TC.red("Removing"), TC.vm(self.get_name()))
-            run(["qvm-remove", "--verbose", self.get_name()], exit_on_failure=True)
-            print(TC.green("Regenerating"), TC.vm(self.get_name()))
+            log.info("%s %s", REMOVING, TC.vm(name))
+            run(["qvm-remove", "--verbose", name], exit_on_failure=True)
+            log.info("%s %s", REGENERATING, TC.vm(name))
             self.apply()
             for vm_name in vms_with_self_as_template:
                 vm = all_vms[vm_name]
-                print(f"Setting {TC.vm(vm_name)} template to {TC.vm(self.get_name())}")
-                run(["qvm-prefs", vm_name, "template", self.get_name()], exit_on_failure=True)
+                log.info("Setting %s template to %s", TC.vm(vm_name), TC.vm(name))
+                run(["qvm-prefs", vm_name, "template", name], exit_on_failure=True)
                 # Qubes cannot remove DispVMTemplate when there are DispVMs that use this as DispVM template
                 if isinstance(vm, DispVMTemplate):
                     vm.create_dispvms()
@@ -594,12 +1065,15 @@ class AppVM(VM):
         self.pci_devices = pci
         for pci_device in self.pci_devices:
             pci_device.set_name(name)
-        qvm_features = {k:v for k, v in qvm_features.items()}
+        # Copy the caller's dict only on the first write; the common case
+        # (neither flag set) adds nothing and can alias it as-is
         if template_for_dispvms == True:
             self.qvm_prefs.set_template_for_dispvms(True)
+            qvm_features = dict(qvm_features)
             qvm_features["appmenus-dispvm"] = "1"
         if anonymous == True:
             self.qvm_prefs.set_anonymous()
+            qvm_features = dict(qvm_features)
             qvm_features["net.fake-ip"] = "192.168.0.2"
             qvm_features["net.fake-gateway"] = "192.168.0.1"
             qvm_features["net.fake-netmask"] = "255.255.255.0"
@@ -608,13 +1082,17 @@ class AppVM(VM):
         self.tags = QVMTags(tags).set_name(name)
     def root_template(self) -> VM:
         return self.template.root_template()
-    def check(self, fix=False):
+    def dependencies(self) -> Optional[VM]:
+        return self.template
+    # AppVMs keep no desired-state checkpoint, so force has nothing to
+    # bypass; accepted for the uniform apply(force=...) signature
+    def check(self, fix=False, force=False):
         needs_update = False
         if not VM.exists(self.get_name()):
             needs_update = True
-            print(f"VM {TC.vm(self.get_name())} does not exist")
+            log.info("VM %s does not exist", TC.vm(self.get_name()))
             if fix:
-                print("Creating VM", TC.vm(self.get_name()))
+                log.info("Creating VM %s", TC.vm(self.get_name()))
                 if isinstance(self, DispVM):
                     run(["qvm-create", "--template", self.template.get_name(), "--class", "DispVM", "--label", self.qvm_prefs.get_label(), self.get_name()], exit_on_failure=True)
                 else:
@@ -630,15 +1108,18 @@ class AppVM(VM):
         for pci_device in self.pci_devices:
             needs_update |= pci_device.check(fix=fix)
         # Services
-        current_services = get_stdout(["qvm-service", "--list", self.get_name()]).splitlines()
+        # qvm-service --list prints "<service>  on|off"; parse it once into a
+        # dict so lookups are exact matches instead of nested startswith scans
+        # (which also matched prefixes, e.g. "netvm" against "netvm-ng")
+        current_services = {}
+        for line in get_stdout(["qvm-service", "--list", self.get_name()]).splitlines():
+            parts = line.split()
+            if parts:
+                current_services[parts[0]] = parts[-1]
         service_update = False
         for service in self.enabled_services:
-            any_line_contains_service = False
-            for line in current_services:
-                if line.startswith(service) and line.endswith("on"):
-                    any_line_contains_service = True
-            if not any_line_contains_service:
-                print(f"VM {self.get_name()} has not enabled service {service}")
+            if current_services.get(service) != "on":
+                log.info("VM %s has not enabled service %s", self.get_name(), service)
                 service_update = True
                 needs_update = True
         if service_update and fix:
@@ -648,7 +1129,25 @@ class AppVM(VM):
             self.apply_salts()
         return needs_update
 
+# Advisory per-VM locks for the parallel lifecycle workers: operations on
+# distinct VMs overlap, but two workers mutating the same VM serialize. The
+# flock additionally guards against a second qa process racing this one.
+_VM_THREAD_LOCKS: Dict[VMName, threading.Lock] = {}
+
+@contextlib.contextmanager
+def _vm_lock(name: VMName):
+    # setdefault is atomic, so concurrent first uses agree on one lock
+    with _VM_THREAD_LOCKS.setdefault(name, threading.Lock()):
+        with open(f"{tempfile.gettempdir()}/qa-{name}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
 class DispVMTemplate(AppVM):
+    # Upgrades happen in the underlying TemplateVM, not here
+    _needs_upgrade = False
     # See superclass AppVM.__init__()
     def __init__(self, name: VMName, template: TemplateVM, qvm_prefs: Optional[QVMPrefs] = None):
         VM.add_vm(self)
@@ -672,69 +1171,145 @@ class DispVMTemplate(AppVM):
         self.tags = QVMTags([]).set_name(name)
     def get_dispvms(self, all_vms: Dict[str, VM]):
         vms_with_self_as_template = [] # List[VM]
-        netvms = {} # Dict[str, str]
-        lines = get_stdout(["qvm-ls", "--raw-data", "--fields", "NAME,TEMPLATE"]).splitlines()
-        for line in lines:
-            if line.endswith(f"|{self.get_name()}"):
-                vm_name = line.split("|")[0]
-                vm_with_self_as_template = None
-                for vm in all_vms.values():
-                    if vm.get_name() == vm_name:
-                        vm_with_self_as_template = vm
-                if vm_with_self_as_template is None:
-                    raise RuntimeError(TC.error("Cannot regenerate DispVM template"), TC.vm(self.get_name()), "because I don't know how to regenerate the DispVM", TC.vm(vm_name))
-                elif not isinstance(vm_with_self_as_template, DispVM):
-                    raise RuntimeError(TC.error("Cannot regenerate the AppVM template"), TC.vm(self.get_name()))
-                vms_with_self_as_template.append(vm_with_self_as_template)
-                for connected_vm in VM.get_vms_connected_to(vm_name):
-                    netvms[connected_vm] = vm_name
+        # netvm name -> VMs connected to it; the shape the start/wire phases
+        # consume, so each netvm appears exactly once
+        netvms = {} # Dict[VMName, List[VMName]]
+        for vm_name in AdminCache.templated_by(self.get_name()):
+            # all_vms is keyed by name already
+            vm_with_self_as_template = all_vms.get(vm_name)
+            if vm_with_self_as_template is None:
+                raise RuntimeError(TC.error("Cannot regenerate DispVM template"), TC.vm(self.get_name()), "because I don't know how to regenerate the DispVM", TC.vm(vm_name))
+            elif not isinstance(vm_with_self_as_template, DispVM):
+                raise RuntimeError(TC.error("Cannot regenerate the AppVM template"), TC.vm(self.get_name()))
+            vms_with_self_as_template.append(vm_with_self_as_template)
+            for connected_vm in VM.get_vms_connected_to(vm_name):
+                netvms.setdefault(vm_name, []).append(connected_vm)
         self.vms_with_self_as_template = vms_with_self_as_template
         self.dispvms_connected_vms = netvms
-    # Must call self.get_dispvms() first
-    def remove_dispvms(self):
+    # Must call self.get_dispvms() first.
+    # fast_remove kills VMs instead of waiting for a graceful guest shutdown;
+    # the disk state is about to be deleted anyway, and a stuck guest agent
+    # can stall qvm-shutdown --wait for tens of seconds
+    def remove_dispvms(self, fast_remove=True):
         self.qubes_default_netvm = None
         self.qubes_default_clockvm = None
-        default_netvm = get_stdout(["qubes-prefs", "default_netvm"])
-        default_clockvm = get_stdout(["qubes-prefs", "clockvm"])
-        for connected_vm, netvm in self.dispvms_connected_vms.items():
-            print(TC.red("Removing"), "netvm", TC.vm(netvm), "from", TC.vm(connected_vm))
+        # One qubes-prefs dump covers both globals instead of one subprocess
+        # (and qrexec round-trip) per pref
+        global_prefs = AdminCache.get_global_prefs()
+        default_netvm = global_prefs.get("default_netvm", "")
+        default_clockvm = global_prefs.get("clockvm", "")
+        # Snapshot the current netvm assignments and running states once: a
+        # connected VM whose netvm is already detached needs no qvm-prefs
+        # fork, and a halted VM needs no kill/shutdown before removal
+        snapshot = AdminCache.load()
+        current_netvm = {name: vm["NETVM"] for name, vm in snapshot.items()}
+        running = {name: vm["STATE"] == "Running" for name, vm in snapshot.items()}
+        def _clear_netvm(item):
+            connected_vm, netvm = item
+            if current_netvm.get(connected_vm) in ("", "-"):
+                return
+            log.info("%s netvm %s from %s", REMOVING, TC.vm(netvm), TC.vm(connected_vm))
             # Set to none so that no updates are done without vpn connections
-            run(["qvm-prefs", connected_vm, "netvm", ""], exit_on_failure=True)
+            with _vm_lock(connected_vm):
+                run(["qvm-prefs", connected_vm, "netvm", ""], exit_on_failure=True)
+        def _stop_one(vm):
+            name = vm.get_name()
+            if not running.get(name, False):
+                return
+            with _vm_lock(name):
+                if fast_remove:
+                    vm.kill()
+                else:
+                    vm.shutdown()
+        # Each connected VM waits on its own qvm-prefs round-trip, so overlap
+        # them
+        clear_pairs = [(connected_vm, netvm)
+                for netvm, connected in self.dispvms_connected_vms.items()
+                for connected_vm in connected]
+        if clear_pairs:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(clear_pairs))) as ex:
+                list(ex.map(_clear_netvm, clear_pairs))
+        # qubes-prefs is global state: keep the bookkeeping serial, then shut
+        # down and remove the now-independent VMs in parallel
         for vm in self.vms_with_self_as_template:
-            if vm.get_name() == default_netvm:
-                self.qubes_default_netvm = vm.get_name()
+            name = vm.get_name()
+            if name == default_netvm:
+                self.qubes_default_netvm = name
                 run(["qubes-prefs", "default_netvm", ""])
-            if vm.get_name() == default_clockvm:
-                self.qubes_default_clockvm = vm.get_name()
+            if name == default_clockvm:
+                self.qubes_default_clockvm = name
                 run(["qubes-prefs", "clockvm", ""])
-            vm.shutdown()
-            print(TC.red("Removing"), TC.vm(vm.get_name()))
-            run(["qvm-remove", "--force", vm.get_name()], exit_on_failure=True)
+        if self.vms_with_self_as_template:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(self.vms_with_self_as_template))) as ex:
+                list(ex.map(_stop_one, self.vms_with_self_as_template))
+            # qvm-remove accepts several names: one interpreter startup and
+            # one qubesd conversation instead of one per VM
+            names = [vm.get_name() for vm in self.vms_with_self_as_template]
+            log.info("%s %s", REMOVING, TC.vm(" ".join(names)))
+            run(["qvm-remove", "--force", *names], exit_on_failure=True)
     # Must call self.remove_dispvms() first
     def create_dispvms(self):
-        for vm in self.vms_with_self_as_template:
-            print(TC.green("Regenerating"), TC.vm(vm.get_name()))
+        def _apply_one(vm):
+            log.info("%s %s", REGENERATING, TC.vm(vm.get_name()))
             vm.apply()
-            if self.qubes_default_netvm == vm.get_name():
-                run(["qubes-prefs", "default_netvm", vm.get_name()])
-            if self.qubes_default_clockvm == vm.get_name():
-                run(["qubes-prefs", "clockvm", vm.get_name()])
-        for connected_vm, netvm in self.dispvms_connected_vms.items():
-            print("Setting netvm", TC.vm(netvm), "for", TC.vm(connected_vm))
-            if VM.vm_running(connected_vm) and not VM.vm_running(netvm):
+        # Recreate the independent VMs in parallel; each apply() fans out to
+        # many qvm-*/salt subprocesses
+        if self.vms_with_self_as_template:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(self.vms_with_self_as_template))) as ex:
+                list(ex.map(_apply_one, self.vms_with_self_as_template))
+        # Global qubes-prefs are restored serially once the pool has joined
+        for vm in self.vms_with_self_as_template:
+            name = vm.get_name()
+            if self.qubes_default_netvm == name:
+                run(["qubes-prefs", "default_netvm", name])
+            if self.qubes_default_clockvm == name:
+                run(["qubes-prefs", "clockvm", name])
+        # Snapshot running states once before wiring: every run() below drops
+        # the AdminCache, which would otherwise force a fresh qvm-ls per
+        # vm_running probe in the loop
+        snapshot = AdminCache.load()
+        running = {name: vm["STATE"] == "Running" for name, vm in snapshot.items()}
+        current_netvm = {name: vm["NETVM"] for name, vm in snapshot.items()}
+        # The grouped shape visits each netvm exactly once: start it if any
+        # of its connected VMs is running, which also leaves the wiring
+        # workers free of any shared start state
+        for netvm, connected in self.dispvms_connected_vms.items():
+            if not running.get(netvm, False) and any(running.get(c, False) for c in connected):
                 run(["qvm-start", "--verbose", netvm])
-            run(["qvm-prefs", connected_vm, "netvm", netvm], exit_on_failure=True)
+                running[netvm] = True
+        def _wire_netvm(item):
+            connected_vm, netvm = item
+            # Already pointing at the right netvm: nothing to write
+            if current_netvm.get(connected_vm) == netvm:
+                return
+            log.info("Setting netvm %s for %s", TC.vm(netvm), TC.vm(connected_vm))
+            with _vm_lock(connected_vm):
+                run(["qvm-prefs", connected_vm, "netvm", netvm], exit_on_failure=True)
+        wire_pairs = [(connected_vm, netvm)
+                for netvm, connected in self.dispvms_connected_vms.items()
+                for connected_vm in connected]
+        if wire_pairs:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(wire_pairs))) as ex:
+                list(ex.map(_wire_netvm, wire_pairs))
     def regenerate(self, all_vms: Dict[str, VM]):
-        if not VM.exists(self.get_name()):
-            print(TC.vm(self.get_name()), "does not exist")
+        name = self.get_name()
+        if not VM.exists(name):
+            log.info("%s does not exist", TC.vm(name))
             self.apply()
             return
         # Qubes cannot remove DispVMTemplate when there are DispVMs that use this as DispVM template
         self.get_dispvms(all_vms)
+        if not self.vms_with_self_as_template and not self.dispvms_connected_vms:
+            # No dependent dispvms: nothing to tear down or rewire
+            log.info("%s %s", REMOVING, TC.vm(name))
+            run(["qvm-remove", "--verbose", name], exit_on_failure=True)
+            log.info("%s %s", REGENERATING, TC.vm(name))
+            self.apply()
+            return
         self.remove_dispvms()
-        print(TC.red("Removing"), TC.vm(self.get_name()))
-        run(["qvm-remove", "--verbose", self.get_name()], exit_on_failure=True)
-        print(TC.green("Regenerating"), TC.vm(self.get_name()))
+        log.info("%s %s", REMOVING, TC.vm(name))
+        run(["qvm-remove", "--verbose", name], exit_on_failure=True)
+        log.info("%s %s", REGENERATING, TC.vm(name))
         self.apply()
         self.create_dispvms()
 
@@ -762,7 +1337,7 @@ class DispVM(AppVM):
         qvm_prefs = QVMPrefs(color, netvm=netvm, provides_network=True, max_memory=0, start_memory=300)
         qvm_prefs.set_name(name)
         return DispVM(name, template, qvm_prefs)
-    def check(self, fix=False):
-        needs_update = super().check(fix=fix)
+    def check(self, fix=False, force=False):
+        needs_update = super().check(fix=fix, force=force)
         needs_update |= self.qvm_features.check(fix)
         return needs_update